@@ -1,22 +1,99 @@
+import numpy as np
 import pandas as pd
 import graphviz
 from typing import List, Dict, Any
 import textwrap
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Character width used when wrapping node labels
+LABEL_WIDTH = 40
+
+# Shared wrapper for scalar labels; same settings as Series.str.wrap
+_WRAPPER = textwrap.TextWrapper(width=LABEL_WIDTH)
+
+# Columns read from the dataset; everything else in the CSV is skipped at load
+USED_COLUMNS = [
+    'Entity.Empowered', 'Triggering.Event', 'Citation', 'Parent.Statute',
+    'Document.Description', 'Describe.Health.Emergency', 'Military.Involvement..Federal.',
+    'Funding.Stream.', 'Funding.Stream.Description',
+]
+
+# Low-cardinality columns used for lookups, stored as categoricals
+CATEGORICAL_COLUMNS = ['Entity.Empowered', 'Triggering.Event']
+
+# Bits of the per-row label flags, in the order of the label columns
+HAS_CITATION, HAS_DESCRIPTION, HAS_HEALTH, HAS_MILITARY, HAS_FUNDING = (1 << i for i in range(5))
+
+# Graph, node and edge defaults written once at the top of every flowchart, so
+# each node only needs its label and fill colour
+GRAPH_DEFAULTS = [
+    '\tbgcolor=white fontsize=28 rankdir=TB size="40,40"',
+    '\tnode [fontsize=24 shape=box style=filled]',
+    '\tedge [fontsize=20]',
+]
+
+# Replaces characters that are unsafe in file names
+_SLUG_TABLE = str.maketrans({c: '_' for c in ' /\\:?*"<>|'})
+
+def _slug(text: str) -> str:
+    """Return a lowercase, file-name-safe version of text."""
+    return text.lower().translate(_SLUG_TABLE)
+
+# Escapes double quotes so text can be embedded in a quoted DOT string
+_DOT_ESCAPE = str.maketrans({'"': '\\"'})
+
+def _quote(text: str) -> str:
+    """Return text as a quoted DOT string."""
+    return f'"{text.translate(_DOT_ESCAPE)}"'
 
 class EmergencyPowerFlowchartGenerator:
     def __init__(self, data_path: str):
         """
         Initialize the flowchart generator with the emergency powers dataset.
         """
-        self.df = pd.read_csv(data_path)
-        self.entities = sorted(self.df['Entity.Empowered'].unique())
-        self.triggers = sorted(self.df['Triggering.Event'].dropna().unique())
+        dtypes = {col: str for col in USED_COLUMNS}
+        dtypes.update({col: 'category' for col in CATEGORICAL_COLUMNS})
+        self.data_path = data_path
+        # Read before loading so an edit during the load can't be cached under the new mtime
+        self._data_mtime = os.path.getmtime(data_path)
+        self.df = pd.read_csv(data_path, usecols=USED_COLUMNS, dtype=dtypes)
+        # Categories are already deduplicated and exclude missing values
+        self.entities = self.df['Entity.Empowered'].cat.categories.sort_values().tolist()
+        self.triggers = self.df['Triggering.Event'].cat.categories.sort_values().tolist()
+        
+        # Row positions per entity and per trigger, so lookups skip the full-table scan
+        self._by_entity = self.df.groupby('Entity.Empowered', observed=True).indices
+        self._by_trigger = {trigger: self._match_trigger(trigger) for trigger in self.triggers}
+        
+        # File-name-safe versions of the known entities and triggers
+        self._slug_entity = {entity: _slug(entity) for entity in self.entities}
+        self._slug_trigger = {trigger: _slug(trigger) for trigger in self.triggers}
         
-    def wrap_text(self, text: str, width: int = 40) -> str:
+    def _match_trigger(self, trigger: str) -> np.ndarray:
+        """Return the row positions whose triggering event contains the trigger."""
+        return self.df['Triggering.Event'].str.contains(trigger, na=False, regex=False).to_numpy().nonzero()[0]
+    
+    def _trigger_rows(self, trigger: str) -> np.ndarray:
+        """
+        Return row positions for a trigger. Known triggers come from the index built
+        at load; other substrings are matched on demand and not stored, so arbitrary
+        input can't grow the index.
+        """
+        rows = self._by_trigger.get(trigger)
+        if rows is None:
+            rows = self._match_trigger(trigger)
+        return rows
+    
+    def wrap_text(self, text: str, width: int = LABEL_WIDTH) -> str:
         """Wrap text to specified width for better visualization."""
-        if pd.isna(text):
+        if text is None or text is pd.NA or text != text:  # None, NA or NaN
             return "N/A"
-        return '\n'.join(textwrap.wrap(str(text), width=width))
+        if width == LABEL_WIDTH:
+            return _WRAPPER.fill(str(text))
+        return textwrap.fill(str(text), width=width)
     
     def get_available_entities(self) -> List[str]:
         """Return list of available empowered entities."""
@@ -26,95 +103,127 @@ class EmergencyPowerFlowchartGenerator:
         """Return list of available triggering events."""
         return self.triggers
     
-    def generate_flowchart(self, entity: str, trigger: str) -> graphviz.Digraph:
+    def generate_flowchart(self, entity: str, trigger: str, dpi: int = 150) -> graphviz.Source:
         """
         Generate a flowchart for the specified empowered entity and triggering event.
+        The dpi only affects raster formats; SVG output is resolution independent.
         """
         # Filter data for the specific entity and trigger
-        filtered_df = self.df[
-            (self.df['Entity.Empowered'] == entity) & 
-            (self.df['Triggering.Event'].str.contains(trigger, na=False))
-        ]
+        rows = np.intersect1d(self._by_entity.get(entity, np.empty(0, dtype=np.intp)), self._trigger_rows(trigger),
+                              assume_unique=True)
+        filtered_df = self.df.take(rows)
         
         if filtered_df.empty:
             raise ValueError(f"No data found for entity '{entity}' and trigger '{trigger}'")
         
-    
-    
-        # Create a new directed graph with adjusted settings
-        dot = graphviz.Digraph(comment=f'{entity} - {trigger} Power Flow')
-        dot.attr(rankdir='TB', size='40,40', dpi='600')
+        # Wrap the detail labels column-wise; missing values stay NaN so rows can skip them
+        funding = filtered_df['Funding.Stream.'] + ("\n" + filtered_df['Funding.Stream.Description']).fillna('')
+        has_citation = filtered_df['Citation'].notna() | filtered_df['Parent.Statute'].notna()
+        citations = (filtered_df['Citation'].fillna('') + ' ' + filtered_df['Parent.Statute'].fillna('')).str.strip()
+        labels = pd.DataFrame({
+            'citation': ("Citation:\n" + citations).str.wrap(LABEL_WIDTH).where(has_citation),
+            'desc': ("Implementation:\n" + filtered_df['Document.Description']).str.wrap(LABEL_WIDTH),
+            'health': ("Health Impact:\n" + filtered_df['Describe.Health.Emergency']).str.wrap(LABEL_WIDTH),
+            'military': ("Military Involvement:\n" + filtered_df['Military.Involvement..Federal.']).str.wrap(LABEL_WIDTH),
+            'funding': ("Funding:\n" + funding).str.wrap(LABEL_WIDTH),
+        })
         
-        # Create main entity and trigger nodes with rank constraints
-        with dot.subgraph(name='cluster_top') as top:
-            top.attr(rank='min')  # Force to top
-            top.node('entity', self.wrap_text(entity), 
-                    shape='box', style='filled', fillcolor='lightblue')
+        # Emit the DOT source directly; rows only append preformatted lines
+        parts = [
+            f'// {entity} - {trigger} Power Flow',
+            'digraph {',
+            f'\tdpi={dpi}',
+            *GRAPH_DEFAULTS,
+        ]
         
-        with dot.subgraph(name='cluster_trigger') as trigger_level:
-            trigger_level.attr(rank='same')  # Force to same level
-            trigger_level.node('trigger', self.wrap_text(trigger), 
-                    shape='diamond', style='filled', fillcolor='lightgreen')
+        # Create main entity and trigger nodes with rank constraints
+        parts += [
+            '\tsubgraph cluster_top {',
+            '\t\trank=min',  # Force to top
+            f'\t\tentity [label={_quote(self.wrap_text(entity))} fillcolor=lightblue]',
+            '\t}',
+            '\tsubgraph cluster_trigger {',
+            '\t\trank=same',  # Force to same level
+            f'\t\ttrigger [label={_quote(self.wrap_text(trigger))} fillcolor=lightgreen shape=diamond]',
+            '\t}',
+            '\tentity -> trigger',
+        ]
         
-        dot.edge('entity', 'trigger')
+        # Which labels each row has, packed into one bitmask per row
+        row_flags = np.packbits(labels.notna().to_numpy(), axis=1, bitorder='little').ravel().tolist()
         
-        # Process each row as a complete unit
-        for idx, row in filtered_df.iterrows():
-            cluster_name = f'cluster_group_{idx}'
-            with dot.subgraph(name=cluster_name) as group:
-                group.attr(label=f'Power Group {idx + 1}', style='filled', fillcolor='white')
+        # Process each row as a complete unit; edges stay at the top level so the
+        # entity and trigger nodes are not pulled into the row's cluster
+        for pos, ((citation, description, health, military, funding), flags) in enumerate(zip(
+                labels.itertuples(index=False, name=None), row_flags)):
+            group = [
+                f'\tsubgraph cluster_group_{pos} {{',
+                f'\t\tfillcolor=white label="Power Group {pos + 1}" style=filled',
+            ]
+            
+            # Create citation node
+            if flags & HAS_CITATION:
+                citation_id = f'citation_{pos}'
+                group.append(f'\t\t{citation_id} [label={_quote(citation)} fillcolor=lightyellow]')
+                parts.append(f'\ttrigger -> {citation_id}')
                 
-                # Create citation node
-                citation = f"{row['Citation']} {row['Parent.Statute']}"
-                if not pd.isna(citation):
-                    citation_id = f'citation_{idx}'
-                    group.node(citation_id, self.wrap_text(f"Citation:\n{citation}"),
-                            shape='box', style='filled', fillcolor='lightyellow')
-                    dot.edge('trigger', citation_id)
-                    
-                    # Add implementation details directly connected to citation
-                    if not pd.isna(row['Document.Description']):
-                        desc_id = f'desc_{idx}'
-                        group.node(desc_id, self.wrap_text(f"Implementation:\n{row['Document.Description']}"),
-                                shape='box', style='filled', fillcolor='lightgray')
-                        dot.edge(citation_id, desc_id)
-                    
-                    # Add health emergency details connected to citation
-                    if not pd.isna(row['Describe.Health.Emergency']):
-                        health_id = f'health_{idx}'
-                        group.node(health_id, self.wrap_text(f"Health Impact:\n{row['Describe.Health.Emergency']}"),
-                                shape='box', style='filled', fillcolor='mistyrose')
-                        dot.edge(citation_id, health_id)
-                    
-                    # Add military involvement if present
-                    if not pd.isna(row['Military.Involvement..Federal.']):
-                        military_id = f'military_{idx}'
-                        group.node(military_id, self.wrap_text(f"Military Involvement:\n{row['Military.Involvement..Federal.']}"),
-                                shape='box', style='filled', fillcolor='lightpink')
-                        dot.edge(citation_id, military_id)
-                    
-                    # Add funding information if present
-                    if not pd.isna(row['Funding.Stream.']):
-                        funding_id = f'funding_{idx}'
-                        funding_text = row['Funding.Stream.']
-                        if not pd.isna(row['Funding.Stream.Description']):
-                            funding_text += f"\n{row['Funding.Stream.Description']}"
-                        group.node(funding_id, self.wrap_text(f"Funding:\n{funding_text}"),
-                                shape='box', style='filled', fillcolor='lightgreen')
-                        dot.edge(citation_id, funding_id)
-
-        return dot
+                # Add implementation details directly connected to citation
+                if flags & HAS_DESCRIPTION:
+                    group.append(f'\t\tdesc_{pos} [label={_quote(description)} fillcolor=lightgray]')
+                    parts.append(f'\t{citation_id} -> desc_{pos}')
+                
+                # Add health emergency details connected to citation
+                if flags & HAS_HEALTH:
+                    group.append(f'\t\thealth_{pos} [label={_quote(health)} fillcolor=mistyrose]')
+                    parts.append(f'\t{citation_id} -> health_{pos}')
+                
+                # Add military involvement if present
+                if flags & HAS_MILITARY:
+                    group.append(f'\t\tmilitary_{pos} [label={_quote(military)} fillcolor=lightpink]')
+                    parts.append(f'\t{citation_id} -> military_{pos}')
+                
+                # Add funding information if present
+                if flags & HAS_FUNDING:
+                    group.append(f'\t\tfunding_{pos} [label={_quote(funding)} fillcolor=lightgreen]')
+                    parts.append(f'\t{citation_id} -> funding_{pos}')
+            
+            group.append('\t}')
+            parts += group
+        
+        parts.append('}')
+        return graphviz.Source('\n'.join(parts) + '\n')
         
-    def save_flowchart(self, dot: graphviz.Digraph, output_path: str, format: str = 'png') -> None:
-        dot.attr(bgcolor='white')    # Ensure white background
-        dot.attr(size='40,40')       # Much larger size
-        dot.attr(dpi='600')          # Double the DPI
-        # Add font size settings for better readability
-        dot.attr('node', fontsize='24')  # Increase node text size
-        dot.attr('edge', fontsize='20')  # Increase edge text size
-        dot.attr('graph', fontsize='28') # Increase graph label size
+    def save_flowchart(self, dot: graphviz.Source, output_path: str, format: str = 'png') -> None:
         dot.render(output_path, format=format, cleanup=True)
 
+    def render_flowchart(self, entity: str, trigger: str, cache_dir: str = 'cache',
+                         format: str = 'png', dpi: int = 150) -> str:
+        """
+        Render a flowchart into the cache directory and return the path to the file.
+        Renders are keyed by entity, trigger, dpi and the modification time of the
+        dataset as it was loaded, so repeat requests reuse the existing file instead
+        of calling Graphviz again.
+        """
+        if entity not in self._slug_entity:
+            raise ValueError(f"Unknown entity '{entity}'")
+        trigger_slug = self._slug_trigger.get(trigger) or _slug(trigger)
+        
+        key = f"{entity}|{trigger}|{dpi}|{self._data_mtime}"
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        output_path = os.path.join(cache_dir, f"flowchart_{self._slug_entity[entity]}_{trigger_slug}_{digest}")
+        if not os.path.exists(f"{output_path}.{format}"):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Render into a scratch directory and move the result into place, so a
+            # failed or concurrent render never leaves a partial file at the cached path
+            scratch_dir = tempfile.mkdtemp(dir=cache_dir)
+            try:
+                scratch_path = os.path.join(scratch_dir, 'flowchart')
+                self.save_flowchart(self.generate_flowchart(entity, trigger, dpi), scratch_path, format=format)
+                os.replace(f"{scratch_path}.{format}", f"{output_path}.{format}")
+            finally:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+        return f"{output_path}.{format}"
+
 def main():
     csv_path = 'CleanDataLong.csv'  # Update with your CSV file name
     
@@ -135,10 +244,8 @@ def main():
     
     # Generate and save flowchart
     try:
-        flowchart = generator.generate_flowchart(entity, trigger)
-        output_path = f"flowchart_{entity.lower().replace(' ', '_')}_{trigger.lower().replace(' ', '_')}"
-        generator.save_flowchart(flowchart, output_path)
-        print(f"\nFlowchart has been generated and saved as '{output_path}.png'")
+        output_path = generator.render_flowchart(entity, trigger)
+        print(f"\nFlowchart has been generated and saved as '{output_path}'")
     except ValueError as e:
         print(f"Error: {e}")
 